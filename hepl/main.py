@@ -1,31 +1,37 @@
 #! /usr/bin/env python3
-import atexit
 import inspect
+import io
 import readline
 import shutil
+import sys
 import tempfile
-from argparse import ArgumentParser, Namespace
-from functools import lru_cache
-from itertools import count
+from argparse import ArgumentParser
+from functools import wraps
 from pathlib import Path
-from typing import NoReturn, Union
+from typing import TYPE_CHECKING, NoReturn, Union
 
-from tableauhyperapi import (
-    Connection,
-    CreateMode,
-    HyperException,
-    HyperProcess,
-    Result,
-    Telemetry,
-)
+# tableauhyperapi loads a native extension that takes noticeable time, so the
+# runtime imports are deferred until a Hyper connection is actually needed
+# (e.g. `hepl --help` shouldn't pay for it)
+if TYPE_CHECKING:
+    from tableauhyperapi import Connection, Result
 
 
 class HeplException(Exception):
     pass
 
 
-# conform to the same interface as the results from the execute_query command
-class HeplResults(list):
+# conform to the same interface as the results from the execute_query command;
+# wraps its rows lazily so callers can stream them without materializing
+class HeplResults:
+    __slots__ = ("rows",)
+
+    def __init__(self, rows=()):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
     def __enter__(self):
         return self
 
@@ -41,33 +47,78 @@ def dot_command(name: str):
         dot_command.commands = {}
 
     def decorated(func):
+        # capture the parameters once here; inspect.signature is slow enough
+        # that re-running it per parser/table build is noticeable
+        sig = inspect.signature(func)
+        func._hepl_params = list(sig.parameters.values())[1:]  # skip connection
         dot_command.commands[name] = func
         return func
 
     return decorated
 
 
+# catalog lookups are IPC round trips to the HyperProcess, so cache them
+# until DDL (or .refresh) invalidates
+_catalog_cache = {}
+
+
+def catalog_cached(func):
+    @wraps(func)
+    def cached(conn: "Connection", *args):
+        key = (func.__name__, *args)
+        if key not in _catalog_cache:
+            # materialize so the cached rows can be shown more than once
+            _catalog_cache[key] = HeplResults(list(func(conn, *args)))
+        return _catalog_cache[key]
+
+    return cached
+
+
+# rows are pre-formatted to strings so show_results doesn't pay per-row
+# formatting for catalogs with thousands of entries
 @dot_command("schemas")
-def dot_schemas(conn: Connection):
-    return HeplResults((schema,) for schema in conn.catalog.get_schema_names())
+@catalog_cached
+def dot_schemas(conn: "Connection"):
+    return HeplResults(str(schema) for schema in conn.catalog.get_schema_names())
 
 
 @dot_command("tables")
-def dot_tables(conn: Connection, schema: str = "public"):
-    return HeplResults((table,) for table in conn.catalog.get_table_names(schema))
+@catalog_cached
+def dot_tables(conn: "Connection", schema: str = "public"):
+    return HeplResults(str(table) for table in conn.catalog.get_table_names(schema))
 
 
 @dot_command("schema")
-def dot_schema(conn: Connection, table: str):
+@catalog_cached
+def dot_schema(conn: "Connection", table: str):
     table_def = conn.catalog.get_table_definition(table)
-    return HeplResults((c.name, c.type) for c in table_def.columns)
+    # tuple rows, unlike the other catalog commands: wide tables repeat a
+    # handful of types, and keeping the interned type string in the row is
+    # what lets each unique one exist only once
+    return HeplResults((str(c.name), sys.intern(str(c.type))) for c in table_def.columns)
+
+
+@dot_command("refresh")
+def dot_refresh(_: "Connection"):
+    _catalog_cache.clear()
+    return HeplResults()
 
 
 @dot_command("exit")
-def dot_exit(_: Connection):
+def dot_exit(_: "Connection"):
     raise EOFError  # simulate ^D
 
 
+@dot_command("help")
+def dot_help(_: "Connection"):
+    global _dot_command_parser
+    if _dot_command_parser is None:
+        _dot_command_parser = make_dot_command_parser()
+
+    _dot_command_parser.print_help()
+    return HeplResults()
+
+
 class DotCommandParserError(HeplException):
     pass
 
@@ -79,27 +130,15 @@ class DotCommandParser(ArgumentParser):
         raise DotCommandParserError(message)
 
 
-def make_dot_command(func, parameters):
-    def dot_cmd(args: Namespace, conn: Connection):
-        formed_args = [getattr(args, p.name) for p in parameters]
-        return func(conn, *formed_args)
-
-    return dot_cmd
-
-
-@lru_cache(maxsize=None)
 def make_dot_command_parser():
     parser = DotCommandParser(prog="", add_help=False, exit_on_error=False)
-    parser.set_defaults(func=None)
     subparsers = parser.add_subparsers()
 
     registered_commands = getattr(dot_command, "commands", {})
     for name, func in sorted(registered_commands.items()):
         subparser = subparsers.add_parser(name, add_help=False, exit_on_error=False)
 
-        sig = inspect.signature(func)
-        parameters = list(sig.parameters.values())[1:]  # skip connection
-        for param in parameters:
+        for param in func._hepl_params:
             kwargs = {}
             if param.annotation != inspect.Parameter.empty:
                 kwargs["type"] = param.annotation
@@ -109,73 +148,240 @@ def make_dot_command_parser():
 
             subparser.add_argument(param.name, **kwargs)
 
-        dot_cmd = make_dot_command(func, parameters)
-        subparser.set_defaults(func=dot_cmd)
-
-    def dot_help_cmd(*_):
-        parser.print_help()
-        return HeplResults()
+    return parser
 
-    # add in help
-    help_parser = subparsers.add_parser("help")
-    help_parser.set_defaults(func=dot_help_cmd)
 
-    return parser
+# built once on first use, only to print help; parsing is too slow for dispatch
+_dot_command_parser = None
 
 
-def handle_dot_command(conn: Connection, command: str) -> HeplResults:
+def make_dot_command_table():
+    registered_commands = getattr(dot_command, "commands", {})
+    table = {}
+    for name, func in registered_commands.items():
+        # resolve the coercion callable per parameter here so dispatch doesn't
+        # re-check the annotation on every invocation
+        specs = [
+            (
+                param.name,
+                param.annotation if param.annotation != inspect.Parameter.empty else None,
+                param.default,
+            )
+            for param in func._hepl_params
+        ]
+        table[name] = (func, specs)
+    return table
+
+
+# dispatch directly from a dict instead of walking argparse subparsers per command
+_dot_command_table = make_dot_command_table()
+
+# commands that take no arguments skip tokenizing entirely
+_fast_dot_commands = {
+    name: func for name, (func, parameters) in _dot_command_table.items() if not parameters
+}
+
+# commands whose parameters all have defaults reuse one prebuilt argument
+# tuple when invoked bare, instead of re-running the coercion loop
+_dot_command_defaults = {
+    name: tuple(default for _, _, default in parameters)
+    for name, (func, parameters) in _dot_command_table.items()
+    if parameters and all(default != inspect.Parameter.empty for _, _, default in parameters)
+}
+
+
+def handle_dot_command(conn: "Connection", command: str) -> HeplResults:
     command = command.lstrip()[1:]  # remove leading whitespace and leading .
 
-    parser = make_dot_command_parser()
-    args = parser.parse_args(command.split())
-    return args.func(args, conn)
+    func = _fast_dot_commands.get(command)
+    if func is not None:
+        return func(conn)
+
+    # single-token commands (e.g. a bare .tables) skip the split allocation
+    if " " not in command and "\t" not in command:
+        name, given = command, ()
+    else:
+        name, *given = command.split() or ("",)
+
+    if not name:
+        raise DotCommandParserError("expected a command")
+
+    if name not in _dot_command_table:
+        raise DotCommandParserError(f"invalid command: {name}")
+
+    func, parameters = _dot_command_table[name]
+    if not given:
+        defaults = _dot_command_defaults.get(name)
+        if defaults is not None:
+            return func(conn, *defaults)
+
+    if len(given) > len(parameters):
+        raise DotCommandParserError(f"too many arguments for command: {name}")
+
+    formed_args = []
+    for i, (param_name, coerce, default) in enumerate(parameters):
+        if i < len(given):
+            value = given[i] if coerce is None else coerce(given[i])
+        elif default != inspect.Parameter.empty:
+            value = default
+        else:
+            raise DotCommandParserError(f"missing argument {param_name} for command: {name}")
+        formed_args.append(value)
+
+    return func(conn, *formed_args)
+
+
+_hepl_dir = Path.home() / ".hepl"
+
+
+def get_hyper_version(conn: "Connection") -> str:
+    # hyper_service_version is an RPC paid on every startup, but the answer
+    # only changes when the installed hyperd binary does; cache it in a file
+    # keyed on the binary's path and mtime
+    import tableauhyperapi
+
+    hyperd = Path(tableauhyperapi.__file__).parent / "bin" / "hyper" / "hyperd"
+    try:
+        stamp = f"{hyperd}:{hyperd.stat().st_mtime_ns}"
+    except OSError:
+        return str(conn.hyper_service_version())
+
+    version_file = _hepl_dir / "hyper_version"
+    try:
+        cached_stamp, version = version_file.read_text().splitlines()
+        if cached_stamp == stamp:
+            return version
+    except (OSError, ValueError):
+        pass
+
+    version = str(conn.hyper_service_version())
+    try:
+        _hepl_dir.mkdir(exist_ok=True)
+        version_file.write_text(f"{stamp}\n{version}\n")
+    except OSError:
+        pass  # the cache is best effort
+    return version
 
 
-def hepl_header(conn: Connection, database: Path):
-    hyper_version = conn.hyper_service_version()
+def hepl_header(conn: "Connection", database: Path):
+    hyper_version = get_hyper_version(conn)
     hepl_version = "0.1"  # TODO
     print(f"Hepl Version: {hepl_version}, Hyper Version: {hyper_version}")
     print('Enter ".help" for usage hints.')
     print(f"Connected to database: {database}")
 
 
-def show_results(results: Union[HeplResults, Result]):
+# rows per stdout write; keeps huge results streaming instead of fully buffered
+_show_chunk_size = 8192
+
+
+def show_results(results: Union[HeplResults, "Result"]):
     col_sep, row_sep = "|", "\n"
+
+    # write encoded bytes straight to the binary stream, skipping the text
+    # layer's codec work per chunk; stdout has no buffer in some environments
+    # (e.g. Jupyter), so fall back to text writes there
+    binary = getattr(sys.stdout, "buffer", None)
+    if binary is None:
+        write = sys.stdout.write
+    else:
+        sys.stdout.flush()  # keep any pending text output ordered before ours
+        # match the text layer's codec so non-UTF-8 terminals still render
+        encoding = sys.stdout.encoding or "utf-8"
+        errors = sys.stdout.errors or "strict"
+
+        def write(text: str):
+            binary.write(text.encode(encoding, errors))
+
+    # HeplResults rows arrive pre-formatted; query Result rows are tuples
+    lines = []
     for row in results:
-        print(col_sep.join(str(x) for x in row), end=row_sep)
+        lines.append(row if isinstance(row, str) else col_sep.join(map(str, row)))
+        if len(lines) >= _show_chunk_size:
+            write(row_sep.join(lines))
+            write(row_sep)
+            lines.clear()
 
+    if lines:
+        write(row_sep.join(lines))
+        write(row_sep)
 
-def get_results(conn: Connection, command: str) -> Union[HeplResults, Result]:
-    if command.startswith("."):
-        return handle_dot_command(conn, command)
+    if binary is not None:
+        binary.flush()  # the binary layer doesn't line-buffer on a terminal
+
+
+# statements that can change what the catalog commands would report
+_ddl_prefixes = ("CREATE", "DROP", "ALTER")
+
+
+def execute_sql(conn: "Connection", command: str) -> "Result":
+    if command.lstrip()[:6].upper().startswith(_ddl_prefixes):
+        _catalog_cache.clear()
     return conn.execute_query(command)
 
 
-def get_command() -> str:
-    buffer = []
+# classify each line with one dict lookup on its first character
+_command_dispatch = {".": handle_dot_command}
+
+
+def get_results(conn: "Connection", command: str) -> Union[HeplResults, "Result"]:
+    return _command_dispatch.get(command[:1], execute_sql)(conn, command)
+
+
+# index scans instead of lstrip/rstrip, so classifying a line doesn't
+# allocate a stripped copy of it
+def is_dot_line(line: str) -> bool:
+    i = 0
+    while i < len(line) and line[i].isspace():
+        i += 1
+    return i < len(line) and line[i] == "."
+
+
+def ends_statement(line: str) -> bool:
+    i = len(line)
+    while i > 0 and line[i - 1].isspace():
+        i -= 1
+    return i > 0 and line[i - 1] == ";"
+
+
+_main_prompt = "hepl> "
+_continuation_prompt = " ...> "
+
 
-    main_prompt = "hepl> "
-    continuation_prompt = " ...> "
-    for linenum in count():
-        prompt = main_prompt if linenum == 0 else continuation_prompt
-        line = input(prompt)
+def get_command() -> str:
+    # the common case is a complete single line (dot commands need no
+    # semicolon), so handle it before setting up the continuation buffer
+    first = input(_main_prompt)
+    if not first:
+        return ""
+    if is_dot_line(first) or ends_statement(first):
+        return first
+
+    # StringIO builds the command in one buffer instead of a list of lines
+    # that gets walked again by a final join
+    buffer = io.StringIO()
+    buffer.write(first)
+    buffer.write("\n")
+    while True:
+        line = input(_continuation_prompt)
         if not line:
             break
-        buffer.append(line)
+        buffer.write(line)
+        buffer.write("\n")
 
-        # no semicolons needed for dot commands
-        if linenum == 0 and line.lstrip().startswith("."):
-            break
         # this could be better
-        if line.rstrip().endswith(";"):
+        if ends_statement(line):
             break
-    return "\n".join(buffer)
+    return buffer.getvalue().rstrip("\n")
 
 
-def hyper_repl(conn: Connection):
+def hyper_repl(conn: "Connection"):
+    from tableauhyperapi import HyperException
+
     while True:
         try:
             command = get_command()
+            save_history()
             if not command:
                 continue
 
@@ -203,15 +409,54 @@ def parse_arguments():
     return args
 
 
+_histfile = Path.home() / ".hepl_history"
+_history_saved = 0  # history length already persisted to _histfile
+
+
 def init_readline():
-    histfile = Path.home() / ".hepl_history"
+    global _history_saved
+
     try:
-        readline.read_history_file(histfile)
-        readline.set_history_length(1000)
-    except FileNotFoundError:
-        pass
+        readline.read_history_file(_histfile)
+    except OSError:
+        # missing or unreadable history is no reason not to start; create the
+        # file if possible, since append_history_file needs it to exist
+        try:
+            _histfile.touch()
+        except OSError:
+            pass
 
-    atexit.register(readline.write_history_file, histfile)
+    readline.set_history_length(1000)
+    if readline.get_current_history_length() > readline.get_history_length():
+        # trim an oversized file once at startup, off the command hot path
+        try:
+            readline.write_history_file(_histfile)
+        except OSError:
+            pass
+
+    _history_saved = readline.get_current_history_length()
+
+
+def save_history():
+    # append only the new entries after each command instead of rewriting the
+    # whole file at exit; this also keeps history if the session crashes
+    global _history_saved
+
+    length = readline.get_current_history_length()
+    if length > _history_saved:
+        try:
+            readline.append_history_file(length - _history_saved, _histfile)
+        except OSError:
+            return  # history is best effort; don't take the session down
+        _history_saved = length
+
+
+def run_repl(endpoint, database: Path):
+    from tableauhyperapi import Connection, CreateMode
+
+    with Connection(endpoint, database, CreateMode.CREATE_IF_NOT_EXISTS) as conn:
+        hepl_header(conn, database)
+        hyper_repl(conn)
 
 
 def main():
@@ -227,15 +472,15 @@ def main():
         temp_dir = Path(tempfile.mkdtemp())
         args.database = temp_dir / "repl.hyper"
 
+    from tableauhyperapi import HyperProcess, Telemetry
+
     parameters = {"log_config": ""}  # don't create a log file
 
     try:
         with HyperProcess(
             Telemetry.DO_NOT_SEND_USAGE_DATA_TO_TABLEAU, parameters=parameters
         ) as hyper:
-            with Connection(hyper.endpoint, args.database, CreateMode.CREATE_IF_NOT_EXISTS) as conn:
-                hepl_header(conn, args.database)
-                hyper_repl(conn)
+            run_repl(hyper.endpoint, args.database)
     finally:
         if temp_dir is not None:
             shutil.rmtree(temp_dir)